@@ -1,21 +1,41 @@
 import os
 import re
 import json
+import copy
 import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
 class WhatsAppChatParser:
-    def __init__(self, model_name='meta-llama/Meta-Llama-3-8B', hf_token=None):
+    # Matches the "date, time - sender: " prefix of every exported line. System
+    # notices have no sender and only serve as message boundaries.
+    _HEADER_RE = re.compile(r'^(\d{1,2}/\d{1,2}/\d{2,4}), (\d{1,2}:\d{2}\s*[APM]*M?) - (?:([^:\n]+): )?', re.MULTILINE)
+    _FILTER_RE = re.compile(r'<Media omitted>|deleted this message|message was deleted', re.IGNORECASE)
+
+    def __init__(self, model_name='meta-llama/Meta-Llama-3-8B', hf_token=None, num_threads=None):
         """
         Initializes the WhatsAppChatParser for parsing and formatting WhatsApp chat data.
 
         Args:
             model_name (str): The name of the model to use for tokenization.
             hf_token (str): The Hugging Face token for authentication.
+            num_threads (int): The number of threads used for tokenization. Defaults to the CPU count.
         """
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=hf_token)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=hf_token, use_fast=True)
+        self.num_threads = num_threads or os.cpu_count()
+        self._thread_local = threading.local()
+        self._executor = None
     
     def load_text_file(self, file_path):
         """
@@ -27,7 +47,7 @@ class WhatsAppChatParser:
         Returns:
             str: The content of the text file.
         """
-        with open(file_path, 'r', encoding='utf-8') as file:
+        with open(file_path, 'r', encoding='utf-8-sig') as file:
             return file.read()
 
     def filter_messages(self, df):
@@ -40,14 +60,14 @@ class WhatsAppChatParser:
         Returns:
             pd.DataFrame: The filtered DataFrame.
         """
-        df = df[~df['message'].str.contains('<Media omitted>')]
-        df = df[~df['message'].str.contains('deleted this message', case=False)]
-        df = df[~df['message'].str.contains('message was deleted', case=False)]
-        return df.reset_index(drop=True)
+        search = self._FILTER_RE.search
+        keep = np.frompyfunc(lambda message: search(message) is None, 1, 1)
+        mask = keep(df['message'].to_numpy()).astype(bool)
+        return df[mask].reset_index(drop=True)
 
     def extract_messages(self, chat_data):
         """
-        Extracts messages from the chat data using regex pattern.
+        Extracts messages from the chat data by locating the header of each message.
 
         Args:
             chat_data (str): The raw chat data.
@@ -55,10 +75,20 @@ class WhatsAppChatParser:
         Returns:
             pd.DataFrame: A DataFrame containing extracted messages.
         """
-        pattern = r'(\d{1,2}/\d{1,2}/\d{2,4}), (\d{1,2}:\d{2}\s*[APM]*M?) - ([^:]+): (.*?)(?=\d{1,2}/\d{1,2}/\d{2,4}, \d{1,2}:\d{2}\s*[APM]*M? - |$)'
-        messages = re.findall(pattern, chat_data, re.DOTALL)
-        messages = [[date, time, sender, message.strip()] for date, time, sender, message in messages]
-        df = pd.DataFrame(messages, columns=['date', 'time', 'sender', 'message'])
+        dates, times, senders, messages = [], [], [], []
+        headers = list(self._HEADER_RE.finditer(chat_data))
+        for i, header in enumerate(headers):
+            date, time, sender = header.groups()
+            if sender is None:
+                continue
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(chat_data)
+            dates.append(date)
+            times.append(time)
+            senders.append(sender)
+            messages.append(chat_data[header.end():end].strip())
+        df = pd.DataFrame({'date': dates, 'time': times, 'sender': senders, 'message': messages}, dtype=str)
+        # Dates repeat for every message of a day, so the parsed values are cached.
+        df['date'] = pd.to_datetime(df['date'], format='%m/%d/%y', cache=True).values.astype('datetime64[D]')
         return self.filter_messages(df)
 
     def calculate_token_length(self, text):
@@ -71,9 +101,125 @@ class WhatsAppChatParser:
         Returns:
             int: The number of tokens.
         """
-        return len(self.tokenizer(text)['input_ids'])
+        return len(self.tokenizer(text, return_attention_mask=False, return_token_type_ids=False)['input_ids'])
+
+    def _thread_tokenizer(self):
+        """
+        Returns the tokenizer owned by the calling thread, copying it on first use.
+
+        A single fast tokenizer shared between threads serializes on its internal
+        lock, so every tokenization thread gets its own instance.
+
+        Returns:
+            PreTrainedTokenizerFast: The tokenizer for the calling thread.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.tokenizer
+        tokenizer = getattr(self._thread_local, 'tokenizer', None)
+        if tokenizer is None:
+            tokenizer = self._thread_local.tokenizer = copy.deepcopy(self.tokenizer)
+        return tokenizer
+
+    def _tokenizer_executor(self):
+        """
+        Returns the thread pool used for tokenization, creating it on first use.
+
+        The pool lives as long as the parser, so its threads and their tokenizer
+        copies are reused by every `format_chat` call.
+
+        Returns:
+            ThreadPoolExecutor: The tokenization thread pool.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def _token_lengths(self, texts):
+        """
+        Calculates the number of tokens in each text fragment with a single batched tokenizer call.
+
+        Args:
+            texts (list[str]): The text fragments.
+
+        Returns:
+            list[int]: The number of tokens in each fragment, without special tokens.
+        """
+        if not texts:
+            return []
+        tokenizer = self._thread_tokenizer()
+        encoding = tokenizer(
+            texts,
+            add_special_tokens=False,
+            padding=False,
+            truncation=False,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            return_length=True,
+        )
+        return encoding['length']
+
+    def _sharded_token_lengths(self, text_lists):
+        """
+        Calculates token lengths for several lists of text fragments across tokenization threads.
+
+        The lists are partitioned into contiguous shards, one per thread, and each
+        shard is tokenized with a single batched call.
+
+        Args:
+            text_lists (list[list[str]]): The lists of text fragments.
+
+        Returns:
+            list[list[int]]: The token lengths, in the same layout as `text_lists`.
+        """
+        if not text_lists:
+            return []
+        num_shards = min(self.num_threads, len(text_lists))
+        shard_size = -(-len(text_lists) // num_shards)
+        shards = [text_lists[i:i + shard_size] for i in range(0, len(text_lists), shard_size)]
+
+        def tokenize_shard(shard):
+            lengths = self._token_lengths([text for texts in shard for text in texts])
+            shard_lengths, offset = [], 0
+            for texts in shard:
+                shard_lengths.append(lengths[offset:offset + len(texts)])
+                offset += len(texts)
+            return shard_lengths
+
+        if len(shards) <= 1:
+            return [lengths for shard in shards for lengths in tokenize_shard(shard)]
+        executor = self._tokenizer_executor()
+        return [lengths for shard_lengths in executor.map(tokenize_shard, shards) for lengths in shard_lengths]
+
+    @staticmethod
+    def _pack_chunks(block_lengths, opening_lengths, header_tokens, max_context_length):
+        """
+        Greedily packs a day's message blocks into chunks using their token lengths.
+
+        Every message starts a new chunk with its opening block and continues the
+        current one with its message block. Each block starts at a pre-tokenizer
+        boundary (whitespace or a tag), so the token count of a chunk is the sum
+        of the lengths of its blocks.
+
+        Args:
+            block_lengths (list[int]): The token lengths of the message blocks.
+            opening_lengths (list[int]): The token lengths of the opening blocks.
+            header_tokens (int): The token length of the chat header.
+            max_context_length (int): The maximum context length for the model.
+
+        Returns:
+            list[int]: The index of the first message of every chunk.
+        """
+        chunk_starts = [0]
+        current_tokens = header_tokens + opening_lengths[0]
+        for i in range(1, len(block_lengths)):
+            if current_tokens + block_lengths[i] < max_context_length:
+                current_tokens += block_lengths[i]
+            else:
+                chunk_starts.append(i)
+                current_tokens = header_tokens + opening_lengths[i]
+        return chunk_starts
 
-    def format_chat(self, df, chat_name, max_context_length):
+    def format_chat(self, df, chat_name, max_context_length, show_progress=True):
         """
         Formats the DataFrame for model input with context length constraints.
 
@@ -81,86 +227,155 @@ class WhatsAppChatParser:
             df (pd.DataFrame): The DataFrame containing chat messages.
             chat_name (str): The name of the chat.
             max_context_length (int): The maximum context length for the model.
+            show_progress (bool): Whether to show a per-day progress bar.
 
         Returns:
             pd.DataFrame: A DataFrame containing formatted chat data.
         """
-        df['date'] = pd.to_datetime(df['date'], format='%m/%d/%y')
-        grouped = df.groupby(df['date'].dt.date)
+        if df.empty:
+            return pd.DataFrame()
+        df = df.sort_values('date', kind='stable').reset_index(drop=True)
 
-        formatted_data = []
-        for date, group in tqdm(grouped, total=len(grouped)):
-            day_chunks = []
-            current_chunk = f"<chat> {chat_name} </chat>\n"
-            previous_sender = None
-            chunk_start_time = None
+        # Days are contiguous after the stable sort, so each one is a slice
+        # of the column arrays between two consecutive boundaries.
+        dates = df['date'].to_numpy().astype('datetime64[D]')
+        all_senders = df['sender'].to_numpy()
+        all_messages = df['message'].to_numpy()
+        all_times = df['time'].to_numpy()
+        boundaries = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1], True])
+
+        header = f"<chat> {chat_name} </chat>\n"
+        header_tokens = self.calculate_token_length(header)
+
+        days = []
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            date = dates[start]
+            senders = all_senders[start:end]
+            messages = all_messages[start:end]
+            times = all_times[start:end]
 
-            for _, row in group.iterrows():
-                sender, message = row['sender'], row['message']
-                if chunk_start_time is None:
-                    chunk_start_time = row['time']
+            message_blocks, opening_blocks = [], []
+            previous_sender = None
+            for sender, message in zip(senders, messages):
                 if sender == previous_sender:
-                    message_block = f" <br>\n{message}"
-                else:
-                    if previous_sender is not None:
-                        message_block = f" </{previous_sender}>\n<{sender}> {message}"
-                    else:
-                        message_block = f"<{sender}> {message}"
-                    previous_sender = sender
-
-                if self.calculate_token_length(current_chunk + message_block) < max_context_length:
-                    current_chunk += message_block
+                    message_blocks.append(f" <br>\n{message}")
+                elif previous_sender is not None:
+                    message_blocks.append(f" </{previous_sender}>\n<{sender}> {message}")
                 else:
-                    day_chunks.append((current_chunk + f" </{previous_sender}>", chunk_start_time))
-                    current_chunk = f"<chat> {chat_name} </chat>\n<{sender}> {message}"
-                    previous_sender = sender
-                    chunk_start_time = row['time']
-            
-            if current_chunk:
-                day_chunks.append((current_chunk + f" </{previous_sender}>", chunk_start_time))
-            
-            for chunk, start_time in day_chunks:
-                formatted_data.append({'date': date, 'time': start_time, 'chat_name': chat_name, 'text': chunk})
+                    message_blocks.append(f"<{sender}> {message}")
+                opening_blocks.append(f"<{sender}> {message}")
+                previous_sender = sender
+            # Every token covers at least one byte, so a day whose UTF-8 size fits
+            # in the context is a single chunk and is never tokenized.
+            fits = header_tokens + len(''.join(message_blocks).encode('utf-8')) < max_context_length
+            days.append((date, senders, times, message_blocks, opening_blocks, fits))
+
+        # The remaining blocks are tokenized up front in batched, sharded calls;
+        # the chunk boundaries are then decided on the token lengths alone.
+        day_lengths = iter(self._sharded_token_lengths([message_blocks + opening_blocks for _, _, _, message_blocks, opening_blocks, fits in days if not fits]))
+
+        formatted_data = []
+        for date, senders, times, message_blocks, opening_blocks, fits in tqdm(days, disable=not show_progress):
+            if fits:
+                chunk_starts = [0]
+            else:
+                lengths = next(day_lengths)
+                block_lengths, opening_lengths = lengths[:len(message_blocks)], lengths[len(message_blocks):]
+                chunk_starts = self._pack_chunks(block_lengths, opening_lengths, header_tokens, max_context_length)
+
+            for start, end in zip(chunk_starts, chunk_starts[1:] + [len(message_blocks)]):
+                chunk = ''.join([header, opening_blocks[start], *message_blocks[start + 1:end], f" </{senders[end - 1]}>"])
+                formatted_data.append({'date': date, 'time': times[start], 'chat_name': chat_name, 'text': chunk})
 
         return pd.DataFrame(formatted_data)
 
+@lru_cache(maxsize=None)
+def _get_parser(model_name, hf_token, num_threads=None):
+    """
+    Returns a WhatsAppChatParser, building it only once per process.
+
+    Args:
+        model_name (str): The name of the model to use for tokenization.
+        hf_token (str): The Hugging Face token for authentication.
+        num_threads (int): The number of threads used for tokenization.
+
+    Returns:
+        WhatsAppChatParser: The parser for this process.
+    """
+    # Parallelism comes from the worker processes and tokenization threads, so
+    # the Rust tokenizer's own thread pool is kept from adding more on top.
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    return WhatsAppChatParser(model_name=model_name, hf_token=hf_token, num_threads=num_threads)
+
+def process_file(file_path, chat_name, model_name, hf_token, max_context_length, num_threads=None):
+    """
+    Loads, parses and formats a single WhatsApp chat history file.
+
+    Args:
+        file_path (str): The path to the chat history file.
+        chat_name (str): The name of the chat.
+        model_name (str): The name of the model to use for tokenization.
+        hf_token (str): The Hugging Face token for authentication.
+        max_context_length (int): The maximum context length for the model.
+        num_threads (int): The number of threads used for tokenization.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing formatted chat data.
+    """
+    parser = _get_parser(model_name, hf_token, num_threads)
+    chat_data = parser.load_text_file(file_path)
+    df = parser.extract_messages(chat_data)
+    # Workers share the parent's stderr, so only the parent's per-file bar is drawn.
+    return parser.format_chat(df, chat_name, max_context_length, show_progress=False)
+
 def main(data_dir, output_path, model_name, hf_token, max_context_length):
     """
     Main function to parse and format WhatsApp chat data for model input.
 
+    Chat files are processed in parallel, one worker process per CPU.
+
     Args:
         data_dir (str): The directory containing WhatsApp chat history files.
         output_path (str): The path to the output CSV file.
         model_name (str): The name of the model to use for tokenization.
         hf_token (str): The Hugging Face token for authentication.
     """
-    parser = WhatsAppChatParser(model_name=model_name, hf_token=hf_token)
-    
     chat_files = [file for file in os.listdir(data_dir) if file.endswith('.txt')]
-    parsed_chat_dfs = []
-    
-    for file_name in chat_files:
-        file_path = os.path.join(data_dir, file_name)
-        chat_data = parser.load_text_file(file_path)
-        parsed_chat_dfs.append(parser.extract_messages(chat_data))
+    file_paths = [os.path.join(data_dir, file_name) for file_name in chat_files]
+    chat_names = [file_name.replace('.txt', '').replace('WhatsApp Chat with', '').strip() for file_name in chat_files]
+
+    # CPUs left over when there are fewer files than cores go to tokenization threads.
+    num_workers = max(1, min(os.cpu_count(), len(chat_files)))
+    num_threads = max(1, os.cpu_count() // num_workers)
 
-    formatted_dfs = []
-    for file_name, df in tqdm(zip(chat_files, parsed_chat_dfs), total=len(parsed_chat_dfs)):
-        chat_name = file_name.replace('.txt', '').replace('WhatsApp Chat with', '').strip()
-        formatted_df = parser.format_chat(df, chat_name, max_context_length)
-        formatted_dfs.append(formatted_df)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(
+            process_file,
+            file_paths,
+            chat_names,
+            [model_name] * len(chat_files),
+            [hf_token] * len(chat_files),
+            [max_context_length] * len(chat_files),
+            [num_threads] * len(chat_files),
+        )
+        formatted_dfs = list(tqdm(results, total=len(chat_files)))
 
     output_csv_path = os.path.join(output_path, 'whatsapp_chats_formatted.csv')
     output_jsonl_path = os.path.join(output_path, 'whatsapp_chats_formatted.jsonl')
 
-    combined_df = pd.concat(formatted_dfs).sort_values(by=['date', 'time']).reset_index(drop=True)
-    combined_df.to_csv(output_csv_path, index=False)
+    combined_df = pd.concat(formatted_dfs, ignore_index=True)
+    order = np.lexsort((combined_df['time'].to_numpy().astype(str), combined_df['date'].to_numpy()))
+    combined_df = combined_df.take(order).reset_index(drop=True)
+    if pa is not None:
+        table = pa.Table.from_pandas(combined_df, preserve_index=False)
+        # Chunk dates are whole days, so they are written as dates rather than midnight timestamps.
+        table = table.set_column(table.schema.get_field_index('date'), 'date', table['date'].cast(pa.date32()))
+        pa_csv.write_csv(table, output_csv_path)
+    else:
+        combined_df.to_csv(output_csv_path, index=False)
 
-    counter = 0
     with open(output_jsonl_path, "w") as f:
-        for _, row in combined_df.iterrows():
-            json.dump({'text': row.text}, f)
-            counter += f.write("\n")
+        f.write(''.join(json.dumps({'text': text}) + "\n" for text in combined_df['text'].to_numpy()))
 
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="Format WhatsApp chat data for LLM")
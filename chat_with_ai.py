@@ -1,7 +1,7 @@
 import os
 import re
-import pandas as pd
 import fireworks.client
+from concurrent.futures import ThreadPoolExecutor
 
 ######################################################################
 # PLEASE SET BELOW VALUES
@@ -34,61 +34,58 @@ FIREWORKS_MODEL_URL = f'accounts/{account_id}/models/{model_id}'
 ######################################################################
 
 def load_text_file(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
+    with open(file_path, 'r', encoding='utf-8-sig') as file:
         return file.read()
 
-def extract_messages(chat_data):
-    pattern = r'(\d{1,2}/\d{1,2}/\d{2,4}), (\d{1,2}:\d{2}\s*[APM]*M?) - ([^:]+): (.*?)(?=\d{1,2}/\d{1,2}/\d{2,4}, \d{1,2}:\d{2}\s*[APM]*M? - |$)'
-    messages = re.findall(pattern, chat_data, re.DOTALL)
-    messages = [[date, time, sender, message.strip()] for date, time, sender, message in messages]
-    df = pd.DataFrame(messages, columns=['date', 'time', 'sender', 'message'])
-    return df
+_SENDER_RE = re.compile(r'^\d{1,2}/\d{1,2}/\d{2,4}, \d{1,2}:\d{2}\s*[APM]*M? - ([^:\n]+): ', re.MULTILINE)
+
+def extract_senders(chat_data):
+    return set(_SENDER_RE.findall(chat_data))
 
 if os.path.exists(DATA_DIR):
-    chat_names = []
-    senders = []
-    for fname in os.listdir(DATA_DIR):
-        chat_names.append(fname.replace('WhatsApp Chat with', '').replace('.txt', '').strip())
-        msgs = load_text_file(os.path.join(DATA_DIR, fname))
-        msgs_df = extract_messages(msgs)
-        for sender in msgs_df['sender'].unique():
-            if sender not in senders:
-                senders.append(sender)
+    fnames = os.listdir(DATA_DIR)
+    chat_names = [fname.replace('WhatsApp Chat with', '').replace('.txt', '').strip() for fname in fnames]
+    # READ ALL CHAT FILES CONCURRENTLY SO THEIR I/O OVERLAPS
+    # ONLY THE SENDERS OF EACH FILE ARE KEPT, NOT THE WHOLE TEXT
+    senders = set()
+    with ThreadPoolExecutor() as executor:
+        senders.update(*executor.map(lambda path: extract_senders(load_text_file(path)), [os.path.join(DATA_DIR, fname) for fname in fnames]))
     
     if CHAT_NAME not in chat_names:
         raise ValueError(f"CHAT_NAME='{CHAT_NAME}' is incorrect. It should be one of {chat_names}")
     if SENDER_NAME not in senders:
-        raise ValueError(f"SENDER_NAME='{SENDER_NAME}' is incorrect. It should be one of {senders}")
+        raise ValueError(f"SENDER_NAME='{SENDER_NAME}' is incorrect. It should be one of {sorted(senders)}")
     if RESPOND_AS not in senders:
-        raise ValueError(f"RESPOND_AS='{RESPOND_AS}' is incorrect. It should be one of {senders}")
+        raise ValueError(f"RESPOND_AS='{RESPOND_AS}' is incorrect. It should be one of {sorted(senders)}")
 else:
     raise ValueError("DATA_DIR doesn't exist. Please give correct path of DATA_DIR.")
 
-# INITIALIZING MESSAGES LIST
-messages = []
-
-def get_reply(messages):
-    prompt = f"<chat> {CHAT_NAME} </chat>"
-    for msg in messages:
-        prompt += f"\n<{msg['sender']}> {msg['content']} </{msg['sender']}>"
-    prompt += f"\n<{RESPOND_AS}>"
-
-    response = fireworks.client.Completion.create(
-        model=FIREWORKS_MODEL_URL,
-        prompt=prompt,
-        max_tokens=500,
-        stop=f"</{RESPOND_AS}>",
-        temperature=0.3,
-        top_k=10,
-        repetition_penalty=1.1,
-    )
-    output_reply = response.choices[0].text.strip()
-    return output_reply
+class ChatSession:
+    def __init__(self, chat_name):
+        # THE PROMPT IS KEPT ACROSS TURNS AND ONLY EVER APPENDED TO
+        self.prompt = f"<chat> {chat_name} </chat>"
+
+    def get_reply(self, content):
+        self.prompt += f"\n<{SENDER_NAME}> {content} </{SENDER_NAME}>"
+
+        response = fireworks.client.Completion.create(
+            model=FIREWORKS_MODEL_URL,
+            prompt=self.prompt + f"\n<{RESPOND_AS}>",
+            max_tokens=500,
+            stop=f"</{RESPOND_AS}>",
+            temperature=0.3,
+            top_k=10,
+            repetition_penalty=1.1,
+        )
+        output_reply = response.choices[0].text.strip()
+        self.prompt += f"\n<{RESPOND_AS}> {output_reply} </{RESPOND_AS}>"
+        return output_reply
+
+# INITIALIZING CHAT SESSION
+chat_session = ChatSession(CHAT_NAME)
 
 while True:
     input_content = input(f'\n{SENDER_NAME}: ')
-    messages.append({'sender': SENDER_NAME, 'content': input_content})
-    output_msg = get_reply(messages)
-    messages.append({'sender': RESPOND_AS, 'content': output_msg})
+    output_msg = chat_session.get_reply(input_content)
     output_msg = output_msg.replace('<br>', '\n\n')
     print(f'\n{RESPOND_AS}: {output_msg}')